@@ -1,45 +1,253 @@
-import base64
+import asyncio
+import atexit
+import functools
 import io
-import json
 import os
+import re
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, List
-
-import gradio as gr
-from firecrawl import FirecrawlApp, ScrapeOptions
-from PIL import Image
-from xai_sdk import Client
-from xai_sdk.chat import image, system, tool, tool_result, user
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Dict, List, Literal
+
+import httpx
+import orjson
+import pybase64
+from cachetools import TTLCache
+import diskcache
 import dotenv
 
 dotenv.load_dotenv()
 
-# Initialize clients
-client = Client(
-    api_key=os.getenv("XAI_API_KEY"),
-    timeout=3600,
+
+@functools.lru_cache(maxsize=None)
+def get_xai_client():
+    """Create the xAI client on first use
+
+    xai_sdk (and its gRPC stack) is imported here rather than at module level
+    so importing this module stays fast.
+    """
+    from xai_sdk import Client
+
+    return Client(
+        api_key=os.getenv("XAI_API_KEY"),
+        timeout=3600,
+    )
+
+
+FIRECRAWL_SEARCH_URL = (
+    os.getenv("FIRECRAWL_API_URL", "https://api.firecrawl.dev") + "/v1/search"
 )
-fc = FirecrawlApp(api_key=os.getenv("FIRECRAWL_API_KEY"))
 
+# Upper bound on simultaneous Firecrawl requests, shared by the connection
+# pool and the per-batch semaphore
+MAX_CONCURRENT_LOOKUPS = 50
 
-def get_medicine_info_fast(name: str) -> Dict:
-    """Super fast medicine info fetcher with aggressive optimization"""
+# Seconds a lookup batch may take before it is reported as timed out, and
+# the per-page scrape budget Firecrawl gets for "full" lookups; most searches
+# return in under two seconds
+LOOKUP_TIMEOUT = 30
+SCRAPE_TIMEOUT_MS = 8000
+
+# Dedicated event loop thread that drives all Firecrawl requests
+event_loop = asyncio.new_event_loop()
+threading.Thread(
+    target=event_loop.run_forever, name="firecrawl-loop", daemon=True
+).start()
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    future = asyncio.run_coroutine_threadsafe(coro, event_loop)
     try:
+        return future.result(timeout)
+    except FuturesTimeoutError:
+        future.cancel()
+        raise
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_client() -> httpx.AsyncClient:
+    """Create the shared HTTP/2 Firecrawl client on first use
+
+    The client is reused across requests so TLS handshakes are amortized. It
+    is only called from the event loop thread, so it is created exactly once.
+    """
+    return httpx.AsyncClient(
+        # The transport retries failed connection attempts; HTTP-level
+        # retries for rate limits and gateway errors are in post_with_retries
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_LOOKUPS,
+                max_keepalive_connections=32,
+            ),
+            retries=2,
+        ),
+        headers={"Authorization": f"Bearer {os.getenv('FIRECRAWL_API_KEY')}"},
+        timeout=httpx.Timeout(30.0, connect=5.0),
+    )
+
+
+# Statuses worth retrying with exponential backoff before falling back
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.2
+
+
+async def post_with_retries(client: httpx.AsyncClient, url: str, payload: Dict):
+    """POST to url, retrying rate-limited and gateway error responses"""
+    for attempt in range(MAX_RETRIES + 1):
+        response = await client.post(url, json=payload)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+
+def close_http_client():
+    """Close the shared Firecrawl client and stop its event loop on exit"""
+    if get_http_client.cache_info().currsize:
+        asyncio.run_coroutine_threadsafe(
+            get_http_client().aclose(), event_loop
+        ).result(timeout=5)
+    event_loop.call_soon_threadsafe(event_loop.stop)
+
+
+atexit.register(close_http_client)
+
+# Successful lookups are cached keyed by detail level and normalized medicine
+# name. Medicine info changes rarely, so entries expire after a day.
+MEDICINE_CACHE_SIZE = 4096
+MEDICINE_CACHE_TTL = 86400
+# Bump when name normalization or the key format changes so entries written
+# under the old keys are never read back
+CACHE_KEY_VERSION = 2
+
+# In-memory LRU tier with per-entry expiry. It is only touched from the event
+# loop thread, so it needs no lock.
+medicine_cache = TTLCache(maxsize=MEDICINE_CACHE_SIZE, ttl=MEDICINE_CACHE_TTL)
+
+
+@functools.lru_cache(maxsize=None)
+def get_disk_cache():
+    """Open the persistent second cache tier on first lookup
+
+    Repeat lookups survive restarts; opening it lazily keeps module import
+    free of disk I/O.
+    """
+    return diskcache.Cache(os.getenv("FIRECRAWL_CACHE_DIR", ".fc_cache"))
+
+
+def disk_cache_get(key: str):
+    """Read a lookup from the disk tier (blocking)"""
+    return get_disk_cache().get(key)
+
+
+def disk_cache_set(key: str, result: Dict) -> None:
+    """Store a lookup in the disk tier for MEDICINE_CACHE_TTL (blocking)"""
+    get_disk_cache().set(key, result, expire=MEDICINE_CACHE_TTL)
+
+
+# A strength at the very end of the name, optionally followed by dosage-form
+# or frequency words, e.g. "Metformin 500 mg tablet BD". Strengths elsewhere
+# are kept so distinct drugs and combination products never share a key.
+DOSAGE_PATTERN = re.compile(
+    r"\s+\d+(?:\.\d+)?\s*(?:mg|mcg|ml|g|iu)\b"
+    r"(?:\s+(?:tab(?:let)?s?|cap(?:sule)?s?|syrup|suspension|injection|drops"
+    r"|cream|ointment|od|bd|tds|qid))*\s*$",
+    re.IGNORECASE,
+)
+
+
+def normalize_medicine_name(name: str) -> str:
+    """Normalize a medicine name for deduplication and cache lookups
+
+    >>> normalize_medicine_name("Metformin 500 mg BD")
+    'metformin'
+    >>> normalize_medicine_name("Paracetamol 650mg Tablet")
+    'paracetamol'
+    >>> normalize_medicine_name("5 mg Amlodipine")
+    '5 mg amlodipine'
+    >>> normalize_medicine_name("Amoxicillin 500mg + Clavulanate 125mg")
+    'amoxicillin 500mg + clavulanate'
+    >>> normalize_medicine_name(" 20 mg ")
+    '20 mg'
+    """
+    normalized = DOSAGE_PATTERN.sub("", name).strip().casefold()
+    # Never collapse a name to an empty key shared by unrelated medicines
+    return normalized or name.strip().casefold()
+
+
+# Scraped pages can be tens of KB; only a clipped excerpt is kept so the tool
+# results re-sent to the model on every turn stay small
+MARKDOWN_LIMIT = 2048
+PRICE_PATTERN = re.compile(r"(?i)(?:price|mrp|₹|\$)[^\n]{0,80}")
+
+
+def clip_markdown(markdown: str) -> str:
+    """Clip scraped markdown, keeping any price lines from the whole page"""
+    if len(markdown) <= MARKDOWN_LIMIT:
+        return markdown
+    prices = list(dict.fromkeys(PRICE_PATTERN.findall(markdown)))[:5]
+    clipped = markdown[:MARKDOWN_LIMIT] + "..."
+    if not prices:
+        return clipped
+    price_lines = "\n".join(f"- {price.strip()}" for price in prices)
+    return f"**Prices found:**\n{price_lines}\n\n{clipped}"
+
+
+def search_payload(name: str, detail: str) -> Dict:
+    """Build the Firecrawl search request for a medicine
+
+    "summary" returns only search metadata (URL and description), which is
+    enough for most reports. "full" also scrapes the result page to markdown.
+    """
+    payload = {"query": f"{name} medicine price availability", "limit": 1}
+    if detail == "full":
+        payload["scrapeOptions"] = {"formats": ["markdown"], "timeout": SCRAPE_TIMEOUT_MS}
+    return payload
+
+
+async def fetch_medicine_info(
+    name: str,
+    sem: asyncio.Semaphore,
+    client: httpx.AsyncClient,
+    detail: Literal["summary", "full"] = "summary",
+) -> Dict:
+    """Fetch medicine info from the Firecrawl search endpoint"""
+    key = f"v{CACHE_KEY_VERSION}:{detail}:{normalize_medicine_name(name)}"
+    cached = medicine_cache.get(key)
+    if cached is not None:
+        return dict(cached, name=name)
+    try:
+        # diskcache is synchronous SQLite; keep it off the shared loop thread
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(None, disk_cache_get, key)
+        if cached is not None:
+            medicine_cache[key] = cached
+            return dict(cached, name=name)
+
         # Ultra-fast search with minimal timeout
-        results = fc.search(
-            query=f"{name} medicine price availability",
-            limit=1,
-            scrape_options=ScrapeOptions(formats=["markdown"], timeout=10000),
-        )
-        snippet = results.data[0] if results.data else {}
-        return {
+        async with sem:
+            response = await post_with_retries(
+                client, FIRECRAWL_SEARCH_URL, search_payload(name, detail)
+            )
+        response.raise_for_status()
+        data = orjson.loads(response.content).get("data") or []
+        snippet = data[0] if data else {}
+        result = {
             "name": name,
-            "info_markdown": snippet.get("markdown", snippet.get("description", "Basic medicine information available")),
+            "info_markdown": clip_markdown(snippet.get("markdown", snippet.get("description", "Basic medicine information available"))),
             "url": snippet.get("url", "N/A"),
             "description": snippet.get("description", f"{name} - Medicine information from search results"),
             "status": "success",
         }
+        # Only lookups that found a page are cached, so fallbacks and empty
+        # searches are retried
+        if data:
+            medicine_cache[key] = result
+            await loop.run_in_executor(None, disk_cache_set, key, result)
+        return result
     except Exception as e:
         # Return quick fallback data instead of error
         return {
@@ -50,48 +258,94 @@ def get_medicine_info_fast(name: str) -> Dict:
             "status": "fallback",
         }
 
+
+async def fetch_all_medicines(
+    medicine_names: List[str], max_workers: int, detail: str
+) -> List:
+    """Fetch all medicines on the shared client, at most max_workers at a time"""
+    # Lookups are cheap coroutines, so concurrency is bounded only by the pool
+    sem = asyncio.Semaphore(max(1, min(max_workers, MAX_CONCURRENT_LOOKUPS)))
+    # fetch_medicine_info never raises, and gather keeps input order
+    client = get_http_client()
+    return await asyncio.gather(
+        *[fetch_medicine_info(n, sem, client, detail) for n in medicine_names]
+    )
+
+
+def timeout_result(name: str) -> Dict:
+    """Placeholder result for a lookup that ran past LOOKUP_TIMEOUT"""
+    return {
+        "name": name,
+        "info_markdown": "Timeout or error",
+        "url": "N/A",
+        "description": "Error: Timed out fetching medicine information",
+        "status": "error",
+    }
+
+
+def get_medicine_info_fast(
+    name: str, detail: Literal["summary", "full"] = "summary"
+) -> Dict:
+    """Super fast medicine info fetcher with aggressive optimization"""
+    try:
+        return run_async(
+            fetch_all_medicines([name], max_workers=1, detail=detail),
+            timeout=LOOKUP_TIMEOUT,
+        )[0]
+    except FuturesTimeoutError:
+        return timeout_result(name)
+
+
 def get_multiple_medicines_concurrent(
-    medicine_names: List[str], max_workers: int = 5
+    medicine_names: List[str],
+    max_workers: int = 20,
+    detail: Literal["summary", "full"] = "summary",
 ) -> List[Dict]:
     """Fetch multiple medicine info concurrently"""
-    results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_medicine = {
-            executor.submit(get_medicine_info_fast, name): name
-            for name in medicine_names
-        }
-        for future in as_completed(future_to_medicine):
-            try:
-                result = future.result(timeout=30)
-                results.append(result)
-            except Exception as e:
-                medicine_name = future_to_medicine[future]
-                results.append(
-                    {
-                        "name": medicine_name,
-                        "info_markdown": "Timeout or error",
-                        "url": "N/A",
-                        "description": f"Error: {str(e)}",
-                        "status": "error",
-                    }
-                )
-    return results
+    # Fetch each distinct medicine once, then fan results back out in order
+    unique_names = {}
+    for medicine_name in medicine_names:
+        unique_names.setdefault(normalize_medicine_name(medicine_name), medicine_name)
+    try:
+        fetched = run_async(
+            fetch_all_medicines(list(unique_names.values()), max_workers, detail),
+            timeout=LOOKUP_TIMEOUT,
+        )
+    except FuturesTimeoutError:
+        return [timeout_result(medicine_name) for medicine_name in medicine_names]
+
+    by_key = dict(zip(unique_names, fetched))
+    return [
+        dict(by_key[normalize_medicine_name(medicine_name)], name=medicine_name)
+        for medicine_name in medicine_names
+    ]
 
 
 # Tool definitions
-tool_definitions = [
-    tool(
+DETAIL_PARAMETER = {
+    "type": "string",
+    "enum": ["summary", "full"],
+    "description": (
+        "'summary' (default) returns URL and description only and is much faster; "
+        "use 'full' only when the full page content is needed"
+    ),
+    "default": "summary",
+}
+
+tool_schemas = [
+    dict(
         name="get_medicine_info_fast",
         description="Fetch markdown info, URL, and description for a medicine via Firecrawl (optimized)",
         parameters={
             "type": "object",
             "properties": {
                 "name": {"type": "string", "description": "Name of the medicine"},
+                "detail": DETAIL_PARAMETER,
             },
             "required": ["name"],
         },
     ),
-    tool(
+    dict(
         name="get_multiple_medicines_concurrent",
         description="Fetch info for multiple medicines concurrently",
         parameters={
@@ -104,72 +358,297 @@ tool_definitions = [
                 },
                 "max_workers": {
                     "type": "integer",
-                    "description": "Maximum concurrent workers (default: 5)",
-                    "default": 5,
+                    "description": "Maximum concurrent workers (default: 20)",
+                    "default": 20,
                 },
+                "detail": DETAIL_PARAMETER,
             },
             "required": ["medicine_names"],
         },
     ),
 ]
 
+
+@functools.lru_cache(maxsize=None)
+def get_tool_definitions():
+    """Build the xAI tool definitions once, frozen so no request can mutate them"""
+    from xai_sdk.chat import tool
+
+    return tuple(tool(**schema) for schema in tool_schemas)
+
+
 tools_map = {
     "get_medicine_info_fast": get_medicine_info_fast,
     "get_multiple_medicines_concurrent": get_multiple_medicines_concurrent,
 }
 
+# Uploads are sent to Grok-4 as JPEGs at most this many pixels on the long
+# edge; prescriptions stay legible well below phone camera resolution
+MAX_IMAGE_SIDE = 1600
+JPEG_QUALITY = 85
+
+# Minimum seconds between partial report updates sent to the UI; the final
+# report is always sent in full
+STREAM_UPDATE_INTERVAL = 0.15
+
+# Seconds to wait for one round of tool calls before continuing without the
+# stragglers; each lookup is already capped at LOOKUP_TIMEOUT
+TOOL_CALL_DEADLINE = 45
+
+# Most tool calls run at once for a single model turn
+MAX_TOOL_WORKERS = 8
+
+# System prompt sent at the start of every analysis chat
+SYSTEM_PROMPT = (
+    "You are MedGuide AI. Extract ALL medicine names from the prescription image. "
+    "If you find multiple medicines, use get_multiple_medicines_concurrent to fetch "
+    "all information at once for faster processing. For single medicine, use get_medicine_info_fast. "
+    "After receiving tool results, immediately produce the final comprehensive markdown report "
+    "with an H2 heading for each medicine that contains: Description, Typical Duration, "
+    "Price Information, and Purchase Link. Do not ask for further instructions."
+)
 
-def encode_image_from_bytes(image_bytes) -> str:
-    """Encode image bytes to base64 string"""
-    return base64.b64encode(image_bytes).decode("utf-8")
 
+@functools.lru_cache(maxsize=None)
+def get_system_message():
+    """Build the system prompt message once and reuse it for every chat"""
+    from xai_sdk.chat import system
 
-def get_image_mime_type(image_bytes):
+    return system(SYSTEM_PROMPT)
+
+
+# Progress log templates for the tool-call loop
+TOOL_CALL_TEMPLATE = (
+    "🛠️ **Tool Call {index}/{total}:**\n\n**Function:** `{func_name}`\n\n"
+    "**Arguments:**\n```json\n{args_display}\n```\n\n⏳ Fetching data from Firecrawl API..."
+)
+TOOL_RESPONSE_TEMPLATE = "✅ **Firecrawl API Response{count}:**\n```json\n{json_display}\n```\n\n"
+
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def get_image_mime_type(image_bytes: bytes):
+    """Detect JPEG/PNG from the file signature without decoding the image"""
+    # startswith compares in place instead of allocating slices
+    if image_bytes.startswith(JPEG_SIGNATURE):
+        return "image/jpeg"
+    if image_bytes.startswith(PNG_SIGNATURE):
+        return "image/png"
+    return None
+
+
+def downscale_image(image_bytes, mime_type):
+    """Re-encode uploads as a JPEG of at most MAX_IMAGE_SIDE pixels
+
+    Returns the (possibly new) image bytes and MIME type. JPEGs already within
+    the limit are passed through untouched.
+    """
+    from PIL import Image, ImageOps
+
+    # Image.open only parses the header, so the size check is cheap
+    img = Image.open(io.BytesIO(image_bytes))
+    if mime_type == "image/jpeg" and max(img.size) <= MAX_IMAGE_SIDE:
+        return image_bytes, mime_type
+
+    # Apply EXIF rotation before the metadata is dropped by re-encoding
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        # Flatten transparency onto white so it doesn't turn black in JPEG
+        background = Image.new("RGBA", img.size, "white")
+        img = Image.alpha_composite(background, img.convert("RGBA"))
+    img = img.convert("RGB")
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+
+def truncate_text(text, limit=100):
+    """Shorten text to limit characters for display, "N/A" when empty"""
+    if not text:
+        return "N/A"
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+def summarize_item(item):
+    """Condense a medicine lookup result for the progress log"""
+    return {
+        "name": item.get("name", "Unknown"),
+        "status": item.get("status", "unknown"),
+        "url": truncate_text(item.get("url"), 80),
+        "info_markdown": truncate_text(item.get("info_markdown")),
+        "description": truncate_text(item.get("description")),
+    }
+
+
+def trim_for_model(result):
+    """Keep only the fields of a tool result the model needs for its report"""
+    if isinstance(result, list):
+        return [trim_for_model(item) for item in result]
+    trimmed = {"name": result.get("name", "Unknown")}
+    description = result.get("description")
+    if description:
+        trimmed["description"] = description
+    # Summary lookups fill info_markdown with the description; send it once
+    markdown = result.get("info_markdown")
+    if markdown and markdown != description:
+        trimmed["info_markdown"] = markdown
+    url = result.get("url")
+    if url and url != "N/A":
+        trimmed["url"] = url
+    # Only flag results the model should treat as unavailable
+    if result.get("status") != "success":
+        trimmed["status"] = result.get("status", "unknown")
+    return trimmed
+
+
+def run_tool_calls(response, chat):
+    """Run the model's tool calls, yielding a ("log", ...) update per step"""
+    from xai_sdk.chat import tool_result
+
+    # Bind hot globals to locals once for the loop below
+    tools = tools_map
+    loads = orjson.loads
+    dumps = orjson.dumps
+
+    tool_calls = response.tool_calls
+    total_calls = len(tool_calls)
+    # A pool per round keeps one session's lookups from queueing behind
+    # another's; each call blocks its worker until its lookups finish
+    pool = ThreadPoolExecutor(
+        max_workers=min(MAX_TOOL_WORKERS, total_calls), thread_name_prefix="tool"
+    )
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        if img.format == "JPEG":
-            return "image/jpeg"
-        elif img.format == "PNG":
-            return "image/png"
-        else:
-            return None
-    except Exception:
-        return None
+        futures = []
+        call_args = []
+        for i, tc in enumerate(tool_calls, 1):
+            func_name = tc.function.name
+            func_args = loads(tc.function.arguments)
+
+            args_display = dumps(func_args, option=orjson.OPT_INDENT_2).decode()
+            yield "log", TOOL_CALL_TEMPLATE.format_map(
+                {
+                    "index": i,
+                    "total": total_calls,
+                    "func_name": func_name,
+                    "args_display": args_display,
+                }
+            )
+
+            # Dispatch every call up front so independent lookups overlap
+            futures.append(pool.submit(tools[func_name], **func_args))
+            call_args.append(func_args)
+
+        # Report each response as soon as it arrives, but never wait past one
+        # shared deadline for the whole round of calls
+        results = {}
+        try:
+            for future in as_completed(futures, timeout=TOOL_CALL_DEADLINE):
+                result = results[future] = future.result()
+
+                # Show API response in JSON format with limited content
+                if isinstance(result, list):
+                    # Multiple medicines response - create summary for each
+                    summary = [summarize_item(item) for item in result]
+                    count = f" ({len(result)} medicines)"
+                else:
+                    # Single medicine response
+                    summary = summarize_item(result)
+                    count = ""
+                json_display = dumps(summary, option=orjson.OPT_INDENT_2).decode()
+
+                yield "log", TOOL_RESPONSE_TEMPLATE.format_map(
+                    {"count": count, "json_display": json_display}
+                )
+        except FuturesTimeoutError:
+            # Give up on stragglers and let the model report them as unavailable
+            for future, func_args in zip(futures, call_args):
+                if future not in results:
+                    future.cancel()
+                    if "medicine_names" in func_args:
+                        results[future] = [timeout_result(n) for n in func_args["medicine_names"]]
+                    else:
+                        results[future] = timeout_result(func_args.get("name", "Unknown"))
+            yield "log", "⚠️ **Tool calls timed out**\n\nContinuing with the results received so far..."
+    finally:
+        # Don't block on stragglers; they were already cancelled or reported
+        pool.shutdown(wait=False)
+
+    # Append results in call order, tagged with their call ids, so each
+    # result is matched to the call that produced it
+    for tc, future in zip(tool_calls, futures):
+        # The UI log above shows the full result; the model gets a trimmed copy
+        serialized = dumps(trim_for_model(results[future])).decode()
+        chat.append(tool_result(serialized, tool_call_id=tc.id))
+
+
+def stream_response(chat, show_partials=True):
+    """Stream a model turn, yielding ("stream", ...) partials; returns the Response"""
+    # Buffer deltas and only join them when an update is actually sent,
+    # instead of growing one string per token
+    parts = []
+    last_emit = 0.0
+    response = None
+    for response, chunk in chat.stream():
+        if chunk.content:
+            parts.append(chunk.content)
+            # Yield the accumulated content so far for real-time
+            # streaming, throttled to coalesce fast token bursts
+            now = time.monotonic()
+            if show_partials and now - last_emit >= STREAM_UPDATE_INTERVAL:
+                last_emit = now
+                yield "stream", "".join(parts)
+    return response
 
 
 def analyze_prescription_streaming(file_bytes):
-    """Analyze prescription with streaming progress updates using generator"""
+    """Analyze prescription with streaming progress updates using generator
+
+    Yields (kind, payload) tuples where kind is "log" for progress logs,
+    "stream" for the partial report and "final" for the finished result.
+    """
+    from xai_sdk.chat import image, user
+
     try:
-        yield "📈 **Starting Analysis...**\n\nValidating uploaded image..."
+        yield "log", "📈 **Starting Analysis...**\n\nValidating uploaded image..."
 
         image_bytes = file_bytes
         mime_type = get_image_mime_type(image_bytes)
         if mime_type is None:
-            yield "Error: Uploaded file is not a valid JPG or PNG image."
-            return
+            # Only decode with PIL when the upload isn't already JPEG/PNG;
+            # other formats it can read (WebP, GIF, ...) are converted to a
+            # downscaled JPEG in the same pass
+            try:
+                image_bytes, mime_type = downscale_image(image_bytes, mime_type)
+            except Exception:
+                yield "final", "Error: Uploaded file is not a valid image."
+                return
 
-        yield "✅ **Image Validated**\n\nPreparing image for AI analysis..."
+            yield "log", "✅ **Image Validated**\n\nPreparing image for AI analysis..."
+        else:
+            yield "log", "✅ **Image Validated**\n\nPreparing image for AI analysis..."
 
-        encoded_img = encode_image_from_bytes(image_bytes)
-        image_data_url = f"data:{mime_type};base64,{encoded_img}"
+            # Full-resolution photos and PNGs waste upload time and vision tokens
+            image_bytes, mime_type = downscale_image(image_bytes, mime_type)
 
-        yield "🤖 **Connecting to Grok-4 AI**\n\nInitializing chat session..."
+        yield "log", "🤖 **Connecting to Grok-4 AI**\n\nInitializing chat session..."
 
         # Create chat session
-        chat = client.chat.create(
+        chat = get_xai_client().chat.create(
             model="grok-4",
-            tools=tool_definitions,
+            tools=get_tool_definitions(),
             tool_choice="auto",
         )
 
         # Enhanced system prompt for better extraction
-        chat.append(
-            system(
-                "You are MedGuide AI. Extract ALL medicine names from the prescription image. "
-                "If you find multiple medicines, use get_multiple_medicines_concurrent to fetch "
-                "all information at once for faster processing. For single medicine, use get_medicine_info_fast. "
-                "Create a comprehensive markdown report."
-            )
+        chat.append(get_system_message())
+
+        # pybase64 encodes a downscaled upload in a few milliseconds, so it
+        # runs inline; encoding straight to str leaves a single concatenation
+        image_data_url = (
+            f"data:{mime_type};base64," + pybase64.b64encode_as_string(image_bytes)
         )
 
         # User provides the prescription image
@@ -180,112 +659,61 @@ def analyze_prescription_streaming(file_bytes):
             )
         )
 
-        yield "🧠 **Image understanding**\n\nExtracting medicine names from prescription..."
+        yield "log", "🧠 **Image understanding**\n\nExtracting medicine names from prescription..."
 
-        # Initial model call
-        response = chat.sample()
+        # Initial model call. Its text is usually planning before tool calls,
+        # so it is buffered rather than shown as a partial report.
+        response = yield from stream_response(chat, show_partials=False)
         chat.append(response)
 
         # Execute tool calls if any
         if response.tool_calls:
-            tool_results = []
-            for i, tc in enumerate(response.tool_calls, 1):
-                func_name = tc.function.name
-                func_args = json.loads(tc.function.arguments)
+            # Show the model's own commentary once rather than with every tool log
+            if response.content:
+                yield "log", f"✨ **Initial AI Response:**\n\n{response.content}"
 
-                args_display = json.dumps(func_args, indent=2)
-                current_progress = f"🛠️ **Tool Call {i}/{len(response.tool_calls)}:**\n\n**Function:** `{func_name}`\n\n**Arguments:**\n```json\n{args_display}\n```\n\n⏳ Fetching data from Firecrawl API..."
-                yield current_progress
+            yield from run_tool_calls(response, chat)
 
-                result = tools_map[func_name](**func_args)
-                tool_results.append((func_name, func_args, result))
-                chat.append(tool_result(json.dumps(result)))
-
-                # Show API response in JSON format with limited content
-                if isinstance(result, list):
-                    # Multiple medicines response - create summary for each
-                    summary_result = []
-                    for item in result:
-                        summary_item = {
-                            "name": item.get('name', 'Unknown'),
-                            "status": item.get('status', 'unknown'),
-                            "url": item.get('url', 'N/A')[:80] + "..." if len(item.get('url', '')) > 80 else item.get('url', 'N/A'),
-                            "info_markdown": item.get('info_markdown', '')[:100] + "..." if len(item.get('info_markdown', '')) > 100 else item.get('info_markdown', 'N/A'),
-                            "description": item.get('description', '')[:100] + "..." if len(item.get('description', '')) > 100 else item.get('description', 'N/A')
-                        }
-                        summary_result.append(summary_item)
-                    
-                    json_display = json.dumps(summary_result, indent=2)
-                    summary = f"✅ **Firecrawl API Response ({len(result)} medicines):**\n```json\n{json_display}\n```"
-                else:
-                    # Single medicine response
-                    summary_item = {
-                        "name": result.get('name', 'Unknown'),
-                        "status": result.get('status', 'unknown'),
-                        "url": result.get('url', 'N/A')[:80] + "..." if len(result.get('url', '')) > 80 else result.get('url', 'N/A'),
-                        "info_markdown": result.get('info_markdown', '')[:100] + "..." if len(result.get('info_markdown', '')) > 100 else result.get('info_markdown', 'N/A'),
-                        "description": result.get('description', '')[:100] + "..." if len(result.get('description', '')) > 100 else result.get('description', 'N/A')
-                    }
-                    
-                    json_display = json.dumps(summary_item, indent=2)
-                    summary = f"✅ **Firecrawl API Response:**\n```json\n{json_display}\n```"
-                
-                yield summary + "\n\n"
-
-            yield "🤔 **Grok 4 is Thinking**\n\nAI is thinking and will soon start generating the report..."
-
-            # Request final formatted report
-            chat.append(
-                user(
-                    "Create a comprehensive markdown report with H2 heading for each medicine that contains: Description, "
-                    "Typical Duration, Price Information, and Purchase Link"
-                )
-            )
+            yield "log", "🤔 **Grok 4 is Thinking**\n\nAI is thinking and will soon start generating the report..."
 
             # Generate final report with streaming
-            accumulated_content = ""
             try:
-                # Use streaming to get the final report
-                stream = chat.stream()
-                for stream_chunk in stream:
-                    # XAI SDK returns tuples with (Response, Chunk)
-                    for item in stream_chunk:
-                        if hasattr(item, 'choices') and item.choices:
-                            choice = item.choices[0]
-                            if hasattr(choice, 'content') and choice.content:
-                                text_content = choice.content
-                                accumulated_content += text_content
-                                # Yield the accumulated content so far for real-time streaming
-                                yield f"📝 **Live Report Generation:**\n\n{accumulated_content}"
-                
+                final = yield from stream_response(chat)
+
                 # Final yield with complete content
-                if accumulated_content:
-                    yield accumulated_content
+                if final.content:
+                    yield "final", final.content
                 else:
                     # Fallback if streaming fails
                     final = chat.sample()
-                    yield final.content
-                    
+                    yield "final", final.content
+
             except Exception as stream_error:
                 # If streaming fails, fallback to regular sample
                 try:
                     final = chat.sample()
-                    yield final.content
+                    yield "final", final.content
                 except Exception as e:
-                    yield f"Error generating final report: {str(e)}"
+                    yield "final", f"Error generating final report: {str(e)}"
         else:
-            yield response.content
+            yield "final", response.content
 
     except Exception as e:
-        yield f"Error analyzing prescription: {str(e)}"
+        yield "final", f"Error analyzing prescription: {str(e)}"
+
+
+# Shown in the report area while progress logs stream into the accordion
+PROCESSING_MESSAGE = "👨‍⚕️ **Processing in progress...**\n\nAnalyzing prescription image and fetching medicine information.\n\n*Check the Processing Logs section below for detailed step-by-step progress.*"
 
 
 # Gradio interface (Blocks version)
 def main():
-    # Processing state to prevent multiple requests
-    processing_state = {"is_processing": False}
+    import gradio as gr
 
     with gr.Blocks(theme=gr.themes.Base()) as demo:
+        # Per-session flag that prevents overlapping requests from one user
+        processing_state = gr.State(False)
+
         gr.Markdown(
             """
             # 🏥MedGuide AI: Prescription Analyzer
@@ -298,7 +726,8 @@ def main():
             with gr.Column():
                 file_input = gr.Image(
                     label="Upload Prescription Image",
-                    type="pil",
+                    type="filepath",
+                    image_mode=None,  # Pass the original upload through untouched
                     height=400,  # Set image component height
                     width=400,  # Set image component width
                     format="png",
@@ -319,10 +748,11 @@ def main():
                         value="Logs will appear here during processing...",
                     )
 
-        def analyze_with_streaming_progress(image):
+        def analyze_with_streaming_progress(image, is_processing):
             """Analyze prescription with streaming progress updates"""
-            # Prevent multiple concurrent requests
-            if processing_state["is_processing"]:
+            # Prevent a second request from the same session; every update
+            # also reports whether this session is still busy
+            if is_processing:
                 yield (
                     "⚠️ **Already Processing:** Please wait for the current analysis to complete.",
                     "Another request is already being processed.",
@@ -330,10 +760,10 @@ def main():
                     gr.update(
                         interactive=True, value="Analyze Prescription"
                     ),  # Keep button enabled for this message
+                    True,
                 )
                 return
 
-            processing_state["is_processing"] = True
             start_time = time.time()
 
             try:
@@ -345,130 +775,86 @@ def main():
                         gr.update(
                             interactive=True, value="Analyze Prescription"
                         ),  # Re-enable button on error
+                        False,
                     )
                     return
 
-                # Convert PIL image to bytes
-                buf = io.BytesIO()
-                image.save(
-                    buf,
-                    format=image.format
-                    if hasattr(image, "format") and image.format
-                    else "PNG",
+                # Show the placeholder and disable the button right away
+                yield (
+                    "🚀 **Processing Started!**\n\nInitializing analysis...",
+                    "Processing...",
+                    "Initializing...",
+                    gr.update(
+                        interactive=False, value="⏳ Processing..."
+                    ),  # Disable button during processing
+                    True,
                 )
-                image_bytes = buf.getvalue()
 
-                # Accumulate all logs to show complete process
-                all_logs = []
-                final_markdown_report = ""
+                # Read the uploaded file as-is instead of re-encoding it
+                with open(image, "rb") as f:
+                    image_bytes = f.read()
 
-                # Use the streaming generator
-                for progress_update in analyze_prescription_streaming(image_bytes):
+                # Accumulate all logs to show complete process; the joined
+                # text is extended once per new log entry and reused for
+                # every yield instead of re-joining the whole list each time
+                logs_text = ""
+
+                # Use the streaming generator, which tags every update with
+                # its kind so no content sniffing is needed here
+                for kind, payload in analyze_prescription_streaming(image_bytes):
                     elapsed = time.time() - start_time
 
-                    # Check if this looks like the final markdown report
-                    # (contains medicine headings, descriptions, or is longer content)
-                    # Also detect streaming report format
-                    # Exclude API responses and tool calls
-                    is_final_report = (
-                        not progress_update.startswith("✅ **Firecrawl API Response")
-                        and not progress_update.startswith("🛠️ **Tool Call")
-                        and not "{" in progress_update  # Exclude JSON responses
-                        and (
-                            progress_update.startswith("# ")
-                            or progress_update.startswith("## ")
-                            or (
-                                "Medicine" in progress_update and len(progress_update) > 100
-                                and not "medicines)" in progress_update  # Exclude API response summaries
-                            )
-                            or ("Description" in progress_update and not "description" in progress_update.lower()[:50])  # Exclude API JSON fields
-                            or ("Price" in progress_update and progress_update.startswith("## "))  # Only markdown headings
-                            or ("Duration" in progress_update and progress_update.startswith("## "))  # Only markdown headings
-                            or ("📝 **Live Report Generation:**" in progress_update and len(progress_update) > 200)
+                    if kind == "stream":
+                        # Show the streaming content in the main report area
+                        yield (
+                            payload,
+                            f"Streaming... {elapsed:.1f}s elapsed",
+                            logs_text,
+                            gr.update(
+                                interactive=False, value="⏳ Processing..."
+                            ),
+                            True,
                         )
-                    )
-                    
-                    # If it's a streaming report, extract the actual content
-                    if "📝 **Live Report Generation:**" in progress_update:
-                        # Extract content after the streaming header
-                        content_start = progress_update.find("📝 **Live Report Generation:**\n\n") + len("📝 **Live Report Generation:**\n\n")
-                        if content_start < len(progress_update):
-                            actual_content = progress_update[content_start:]
-                            # Check if the actual content looks like a report
-                            if (
-                                actual_content.startswith("# ")
-                                or actual_content.startswith("## ")
-                                or "Medicine" in actual_content
-                                or "Description" in actual_content
-                                or len(actual_content) > 50
-                            ):
-                                # Show the streaming content in the main report area
-                                yield (
-                                    actual_content,
-                                    f"Streaming... {elapsed:.1f}s elapsed",
-                                    "\n\n".join(all_logs),
-                                    gr.update(
-                                        interactive=False, value="⏳ Processing..."
-                                    ),
-                                )
-                                continue
-                    
-                    if is_final_report:
+                    elif kind == "final":
                         # This is the final report - show in main report, keep logs in accordion
-                        final_markdown_report = progress_update
-                        final_logs = (
-                            "\n\n".join(all_logs)
-                            if all_logs
-                            else "Processing completed successfully!"
-                        )
+                        final_logs = logs_text or "Processing completed successfully!"
                         yield (
-                            final_markdown_report,
+                            payload,
                             f"✅ Completed in {elapsed:.2f} seconds",
                             final_logs,
                             gr.update(
                                 interactive=True, value="Analyze Prescription"
                             ),  # Re-enable button
+                            False,
                         )
                         return
                     else:
                         # This is a process log - accumulate and show in logs section
-                        all_logs.append(progress_update)
+                        logs_text = (
+                            f"{logs_text}\n\n{payload}" if logs_text else payload
+                        )
                         # Show processing message in main area, detailed logs in accordion
-                        processing_message = "👨‍⚕️ **Processing in progress...**\n\nAnalyzing prescription image and fetching medicine information.\n\n*Check the Processing Logs section below for detailed step-by-step progress.*"
                         yield (
-                            processing_message,
+                            PROCESSING_MESSAGE,
                             f"Processing... {elapsed:.1f}s elapsed",
-                            "\n\n".join(all_logs),
+                            logs_text,
                             gr.update(
                                 interactive=False, value="⏳ Processing..."
                             ),  # Keep button disabled during processing
+                            True,
                         )
 
-                # If we somehow don't detect the final report, show the last update
-                if not final_markdown_report:
-                    elapsed = time.time() - start_time
-                    final_logs = (
-                        "\n\n".join(all_logs) if all_logs else "Processing completed."
-                    )
-                    # Check if the last update could be the report
-                    if all_logs and len(all_logs[-1]) > 50:
-                        yield (
-                            all_logs[-1],
-                            f"✅ Completed in {elapsed:.2f} seconds",
-                            final_logs,
-                            gr.update(
-                                interactive=True, value="Analyze Prescription"
-                            ),  # Re-enable button
-                        )
-                    else:
-                        yield (
-                            "Analysis completed. Please check the processing logs for details.",
-                            f"✅ Completed in {elapsed:.2f} seconds",
-                            final_logs,
-                            gr.update(
-                                interactive=True, value="Analyze Prescription"
-                            ),  # Re-enable button
-                        )
+                # The generator ended without a final result
+                elapsed = time.time() - start_time
+                yield (
+                    "Analysis completed. Please check the processing logs for details.",
+                    f"✅ Completed in {elapsed:.2f} seconds",
+                    logs_text or "Processing completed.",
+                    gr.update(
+                        interactive=True, value="Analyze Prescription"
+                    ),  # Re-enable button
+                    False,
+                )
             except Exception as e:
                 # Handle any unexpected errors
                 elapsed = time.time() - start_time
@@ -479,43 +865,14 @@ def main():
                     gr.update(
                         interactive=True, value="Analyze Prescription"
                     ),  # Re-enable button on error
+                    False,
                 )
-            finally:
-                # Always reset processing state
-                processing_state["is_processing"] = False
-
-        def show_initial_processing(image):
-            """Show initial processing message and disable button"""
-            if image is None:
-                return (
-                    "❌ **Error:** Please upload an image first.",
-                    "No image provided.",
-                    "Logs will appear here during processing...",
-                    gr.update(
-                        interactive=True, value="Analyze Prescription"
-                    ),  # Keep enabled if no image
-                )
-            return (
-                "🚀 **Processing Started!**\n\nInitializing analysis...",
-                "Processing...",
-                "Initializing...",
-                gr.update(
-                    interactive=False, value="⏳ Processing..."
-                ),  # Disable button during processing
-            )
 
         # Event handlers
-        analyze_btn.click(
-            show_initial_processing,
-            inputs=[file_input],
-            outputs=[report_output, time_output, logs_output, analyze_btn],
-            queue=False,
-        )
-
         analyze_btn.click(
             analyze_with_streaming_progress,
-            inputs=[file_input],
-            outputs=[report_output, time_output, logs_output, analyze_btn],
+            inputs=[file_input, processing_state],
+            outputs=[report_output, time_output, logs_output, analyze_btn, processing_state],
             queue=True,
         )
 
@@ -547,7 +904,11 @@ def main():
                 """
             )
 
-    demo.launch()
+    # Run up to four analyses at once and bound the waiting line; each
+    # analysis mostly waits on Grok-4 and Firecrawl rather than the CPU
+    demo.queue(default_concurrency_limit=4, max_size=32, api_open=False).launch(
+        max_threads=40, server_name="0.0.0.0", show_error=True
+    )
 
 
 if __name__ == "__main__":